@@ -1,64 +1,63 @@
 #!/usr/bin/env python3
 
+import io
 import os
-import boto3
-import shutil
+import sys
+import json
+import time
+import atexit
+import base64
+import hashlib
 import socket
 import logging
 import argparse
-import requests
+import posixpath
+import selectors
 import threading
 import subprocess
 from typing import Dict
-from bisect import bisect
+from concurrent.futures import ThreadPoolExecutor
 from logging import Formatter, LogRecord, StreamHandler
 from datetime import datetime, timezone
 
 # ##################################################################
 # Logging stuff
 # ##################################################################
-class Colours:
-    OFF     = '\033[0m'
-    RED     = '\033[91m'
-    GREEN   = '\033[92m'
-    YELLOW  = '\033[93m'
-    BLUE    = '\033[94m'
-    MAGENTA = '\033[95m'
-    CYAN    = '\033[96m'
-
-    def __init__(self, nocolor=False):
-        self.__set_nocolor__(nocolor)
-
-    def __set_nocolor__(self, nocolor):
-        if not nocolor:
-            self.OFF     = '\033[0m'
-            self.RED     = '\033[91m'
-            self.GREEN   = '\033[92m'
-            self.YELLOW  = '\033[93m'
-            self.BLUE    = '\033[94m'
-            self.MAGENTA = '\033[95m'
-            self.CYAN    = '\033[96m'
-        else:
-            self.OFF     = ''
-            self.RED     = ''
-            self.GREEN   = ''
-            self.YELLOW  = ''
-            self.BLUE    = ''
-            self.MAGENTA = ''
-            self.CYAN    = ''
-
-
-COLOURS = Colours(
-    bool(
+# ANSI colour codes for the log output, selected once at import time.
+# Set one of the environment variables 'NOCOLOR' or 'nocolor' to start
+# without colours.
+COLOUR_CODES = {
+    'OFF':     '\033[0m',
+    'RED':     '\033[91m',
+    'GREEN':   '\033[92m',
+    'YELLOW':  '\033[93m',
+    'BLUE':    '\033[94m',
+    'MAGENTA': '\033[95m',
+    'CYAN':    '\033[96m',
+}
+
+NO_COLOUR_CODES = dict.fromkeys(COLOUR_CODES, '')
+
+COLOURS = NO_COLOUR_CODES if bool(
+    os.environ.get(
+        'nocolor',
         os.environ.get(
-            'nocolor',
-            os.environ.get(
-                'NOCOLOR',
-                False
-            )
+            'NOCOLOR',
+            False
         )
     )
-)
+) else COLOUR_CODES
+
+
+class BufferedStreamHandler(StreamHandler):
+    """A StreamHandler that doesn't flush after every record.
+
+    Records accumulate in the wrapped buffer and reach stderr in large
+    chunks; the buffer is flushed at interpreter exit instead.
+    """
+
+    def flush(self):
+        pass
 
 
 class Logger:
@@ -72,25 +71,39 @@ class Logger:
     CRITICAL = 50
 
     def __init__(self, args=None):
-        handler = StreamHandler()
-        handler.setFormatter(
-            LevelFormatter(
-                {
-                    self.TRACE: f'{COLOURS.MAGENTA}TRACE: %(message)s{COLOURS.OFF}',
-                    self.DEBUG: f'{COLOURS.CYAN}%(levelname)s: %(message)s{COLOURS.OFF}',
-                    self.INFO: '%(message)s',
-                    self.WARNING: f'{COLOURS.GREEN}%(levelname)s: %(message)s{COLOURS.OFF}',
-                    self.ERROR: f'{COLOURS.RED}%(levelname)s: %(message)s{COLOURS.OFF}',
-                    self.CRITICAL: f'{COLOURS.YELLOW}%(levelname)s: %(message)s{COLOURS.OFF}',
-                }
-            )
+        buffered = io.TextIOWrapper(
+            io.BufferedWriter(sys.stderr.buffer, buffer_size=65536),
+            write_through=False
         )
+        atexit.register(buffered.flush)
+        handler = BufferedStreamHandler(buffered)
+        handler.setFormatter(self.__makeFormatter(COLOURS))
         handler.setLevel(1)
 
+        self.__handler = handler
+        logging.addLevelName(self.TRACE, 'TRACE')
         self.__logger = logging.getLogger(__name__)
         self.__logger.addHandler(handler)
         self.setLevelFromArgs(args)
 
+    def __makeFormatter(self, colours):
+        return LevelFormatter(
+            {
+                self.TRACE: f'{colours["MAGENTA"]}TRACE: %(message)s{colours["OFF"]}',
+                self.DEBUG: f'{colours["CYAN"]}%(levelname)s: %(message)s{colours["OFF"]}',
+                self.INFO: '%(message)s',
+                self.WARNING: f'{colours["GREEN"]}%(levelname)s: %(message)s{colours["OFF"]}',
+                self.ERROR: f'{colours["RED"]}%(levelname)s: %(message)s{colours["OFF"]}',
+                self.CRITICAL: f'{colours["YELLOW"]}%(levelname)s: %(message)s{colours["OFF"]}',
+            }
+        )
+
+    def setNoColour(self):
+        self.__handler.setFormatter(self.__makeFormatter(NO_COLOUR_CODES))
+
+    def setJson(self):
+        self.__handler.setFormatter(JSONFormatter())
+
     def setLevelFromArgs(self, args=None):
         loglevel = self.INFO
         if os.environ.get('TRACE', None) is not None or (args is not None and args.trace):
@@ -104,26 +117,29 @@ class Logger:
     def setLevel(self, loglevel):
         self.__logger.setLevel(loglevel)
 
-    def trace(self, message):
-        self.__logger.log(self.TRACE, message)
+    def isEnabledFor(self, loglevel):
+        return self.__logger.isEnabledFor(loglevel)
+
+    def trace(self, message, *args):
+        self.__logger.log(self.TRACE, message, *args)
 
-    def debug(self, message):
-        self.__logger.debug(message)
+    def debug(self, message, *args):
+        self.__logger.debug(message, *args)
 
-    def info(self, message):
-        self.__logger.info(message)
+    def info(self, message, *args):
+        self.__logger.info(message, *args)
 
-    def warning(self, message):
-        self.__logger.warning(message)
+    def warning(self, message, *args):
+        self.__logger.warning(message, *args)
 
-    def warn(self, message):
-        self.__logger.warning(message)
+    def warn(self, message, *args):
+        self.__logger.warning(message, *args)
 
-    def error(self, message):
-        self.__logger.error(message)
+    def error(self, message, *args):
+        self.__logger.error(message, *args)
 
-    def critical(self, message):
-        self.__logger.critical(message)
+    def critical(self, message, *args):
+        self.__logger.critical(message, *args)
 
 
 class LevelFormatter(Formatter):
@@ -140,19 +156,111 @@ class LevelFormatter(Formatter):
             (level, Formatter(fmt, **kwargs)) for level, fmt in formats.items()
         )
 
+        # A direct levelno -> Formatter table: each slot holds the
+        # formatter of the nearest configured level at or above it,
+        # matching what the old bisect lookup resolved, so format() is
+        # a single index per record.
+        self._max = self.formats[-1][0]
+        table = [None] * (self._max + 1)
+        levels = iter(self.formats)
+        level, formatter = next(levels)
+        for idx in range(self._max + 1):
+            if idx > level:
+                level, formatter = next(levels)
+            table[idx] = formatter
+        self._table = table
+
     def format(self, record: LogRecord) -> str:
-        idx = bisect(self.formats, (record.levelno,), hi=len(self.formats)-1)
-        _, formatter = self.formats[idx]
-        return formatter.format(record)
+        return self._table[min(record.levelno, self._max)].format(record)
 
 
-def stream_output(stream, stderr=False):
-    """Reads from a stream line-by-line and prints in real-time."""
-    for line in iter(stream.readline, ''):
-        if stderr:
-            logger.error(line.strip())
+class JSONFormatter(Formatter):
+    """Formats each record as a single-line JSON document.
+
+    A message that is already a dict is embedded as-is, so structured
+    events (like the end-of-run summary) come out as queryable JSON.
+    """
+
+    def format(self, record: LogRecord) -> str:
+        if isinstance(record.msg, dict) and not record.args:
+            message = record.msg
         else:
-            logger.debug(line.strip())
+            message = record.getMessage()
+        return json.dumps(
+            {'level': record.levelname, 'message': message},
+            default=str
+        )
+
+
+def stream_output(stream, stderr=False):
+    """Drains a pipe in blocks and logs lines in batches.
+
+    The pipe is read non-blocking through a selector, so the batch flush
+    fires on time even when the subprocess goes quiet mid-batch. Lines
+    are held back and emitted as one log record when either 64 KiB has
+    accumulated or 50ms has passed, so a chatty subprocess doesn't pay
+    the logging overhead once per line.
+    """
+    log = logger.error if stderr else logger.debug
+    buffer = bytearray()
+    batch = []
+    pending = 0
+    deadline = time.monotonic() + 0.05
+
+    def flush():
+        nonlocal pending, deadline
+        if batch:
+            log('\n'.join(batch))
+            batch.clear()
+            pending = 0
+        deadline = time.monotonic() + 0.05
+
+    fd = stream.fileno()
+    os.set_blocking(fd, False)
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    try:
+        eof = False
+        while not eof:
+            timeout = max(0.0, deadline - time.monotonic())
+            for _ in sel.select(timeout=timeout):
+                try:
+                    block = os.read(fd, 65536)
+                except BlockingIOError:
+                    continue
+                if not block:
+                    eof = True
+                    break
+                buffer.extend(block)
+                while True:
+                    newline = buffer.find(b'\n')
+                    if newline < 0:
+                        break
+                    line = buffer[:newline].decode(errors='replace').rstrip()
+                    del buffer[:newline + 1]
+                    batch.append(line)
+                    pending += len(line)
+            if pending >= 65536 or time.monotonic() >= deadline:
+                flush()
+    finally:
+        sel.close()
+
+    if buffer:
+        batch.append(buffer.decode(errors='replace').rstrip())
+    flush()
+
+
+class CountingReader:
+    """Wraps a binary stream and counts the bytes read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        block = self.stream.read(size)
+        self.bytes_read += len(block)
+        return block
 
 
 # ##################################################################
@@ -201,10 +309,15 @@ def parseArgs() -> dict:
         action='store_true',
         help="Ensure logs have no colour to them. Also can be set by setting one of the environment variables 'NOCOLOR' or 'nocolor' to True."
     )
+    parser.add_argument(
+        '--log-json',
+        action='store_true',
+        help="Emit each log record as a single-line JSON document, and a one-line summary of the run instead of the human-readable upload message."
+    )
     parser.add_argument(
         '--context',
-        default=socket.getfqdn(),
-        help="Specify an encryption context for later retrieval (e.g. hostname, cronjob or process). Only used when the destination filename isn't specified."
+        default=None,
+        help="Specify an encryption context for later retrieval (e.g. hostname, cronjob or process). Defaults to the host's FQDN. Only used when the destination filename isn't specified."
     )
     parser.add_argument(
         '--target-path', '-p',
@@ -213,10 +326,18 @@ def parseArgs() -> dict:
     )
     result = parser.parse_args()
     if result.destination is None:
-        result.destination = f'{result.source}.{datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")}z.{result.context}.enc'
+        # getfqdn can block on reverse DNS, so only resolve it when the
+        # context is actually needed to build the destination name.
+        if result.context is None:
+            result.context = socket.getfqdn()
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H-%M-%S")
+        result.destination = f'{result.source}.{timestamp}z.{result.context}.enc'
 
     if result.nocolor:
-        COLOURS.__set_nocolor__(True)
+        logger.setNoColour()
+
+    if result.log_json:
+        logger.setJson()
 
     if len(os.environ.get('DEBUG', "")) > 0:
         if not result.debug:
@@ -242,7 +363,8 @@ def parseArgs() -> dict:
     if os.path.exists(result.destination) and not result.overwrite:
         raise FileExistsError(f'File {result.destination} already exists')
 
-    result.target = f"{result.target_path}{'/' if len(result.target_path) > 0 and result.target_path[:-1] != '/' else ''}{os.path.basename(result.destination)}"
+    basename = os.path.basename(result.destination)
+    result.target = posixpath.join(result.target_path, basename)
 
     logger.trace(vars(result))
 
@@ -255,67 +377,116 @@ def parseArgs() -> dict:
 logger = Logger()
 
 def main() -> None:
+    started = time.monotonic()
+
+    # http.client defaults to an 8 KiB write buffer, which throttles the
+    # multipart PUTs with lots of tiny socket sends. Raise the default
+    # blocksize to 1 MiB before any boto3 client is created.
+    from http.client import HTTPConnection
+    HTTPConnection.__init__.__defaults__ = tuple(
+        1024 * 1024 if x == 8192 else x
+        for x in HTTPConnection.__init__.__defaults__
+    )
+
     args = parseArgs()
 
-    region = os.environ.get(
-        'AWS_REGION',
-        os.environ.get(
-            'AWS_DEFAULT_REGION',
-            None
-        )
+    # boto3 parses thousands of service model files at import time, so
+    # only pay for that once the arguments have validated; invocations
+    # with missing settings fail fast instead.
+    import boto3
+    import botocore.config
+    import botocore.session
+    from botocore.utils import InstanceMetadataRegionFetcher
+    from boto3.s3.transfer import TransferConfig
+
+    # Parallelise multipart uploads. Tune the thread count with the
+    # environment variable "S3_MAX_CONCURRENCY".
+    max_concurrency = int(os.environ.get('S3_MAX_CONCURRENCY', 10))
+    transfer_cfg = TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=max_concurrency,
+        use_threads=True
     )
 
+    needs_account_id = (
+        str(args['kms_arn']).startswith('alias/')
+        or str(args['kms_arn']).startswith('key/')
+    )
+
+    core_session = botocore.session.Session()
+    region = core_session.get_config_variable('region')
+
     if region is None:
         logger.trace(
-            'AWS Region not specified in an environment variable. Checking options.')
-        try:
-            region = requests.get(
-                "http://169.254.169.254/latest/meta-data/placement/region",
-                timeout=2
-            ).text
-        except requests.RequestException as e:
-            raise Exception(f"Error fetching region: {e}")
-
-    if str(args['kms_arn']).startswith('alias/') or str(args['kms_arn']).startswith('key/'):
+            'AWS Region not specified in an environment variable or config. Checking instance metadata.')
+        fetch_region = InstanceMetadataRegionFetcher(
+            timeout=2,
+            num_attempts=2
+        ).retrieve_region
+        if needs_account_id:
+            # The STS lookup that completes the KMS ARN needs resolved
+            # credentials, and resolving them doesn't depend on the
+            # region, so run both metadata fetches concurrently and pay
+            # only for the slower of the two.
+            with ThreadPoolExecutor(2) as executor:
+                region_future = executor.submit(fetch_region)
+                credentials_future = executor.submit(
+                    core_session.get_credentials)
+                region = region_future.result()
+                credentials_future.result()
+        else:
+            region = fetch_region()
+        if region is None:
+            raise Exception('Error fetching region from instance metadata')
+
+    # One session shared by every client, so credentials, endpoints and
+    # the underlying connection pool are only resolved once.
+    session = boto3.session.Session(
+        botocore_session=core_session,
+        region_name=region
+    )
+    client_cfg = botocore.config.Config(
+        max_pool_connections=max_concurrency,
+        tcp_keepalive=True,
+        retries={'max_attempts': 10, 'mode': 'adaptive'}
+    )
+
+    if needs_account_id:
         logger.trace('KMS ARN does not have an account ID. Checking options.')
-        iam_data = requests.get(
-            "http://169.254.169.254/latest/meta-data/iam/info",
-            timeout=2
-        ).json()
-        iam_arn = iam_data.get('InstanceProfileArn', None)
-        if iam_arn is None:
-            raise Exception('Unable to find account ID to complete KMS ARN')
-        account_id = iam_arn.split(":")[4]
+        account_id = session.client(
+            'sts', config=client_cfg).get_caller_identity()['Account']
         args['kms_arn'] = f'arn:aws:kms:{region}:{account_id}:{args["kms_arn"]}'
 
-    shutil.copy2(args['source'], args['destination'])
-
     command = [
         "sops",
-        "--in-place", "--encrypt", args['destination'],
+        "--encrypt",
+        "--input-type", "binary",
         "--output-type", "binary",
+        args['source'],
     ]
 
     env = os.environ.copy()
     env['SOPS_KMS_ARN'] = args['kms_arn']
 
-    logger.trace(f'Starting encryption with {command}')
+    logger.trace('Creating S3 client')
+    s3_client = session.client('s3', config=client_cfg)
+
+    logger.trace('Starting encryption with %r', command)
+
+    # The encrypted size isn't known until sops finishes, so branch on
+    # the source size: small backups go out as one plain PUT instead of
+    # paying the multipart setup overhead.
+    small_source = os.path.getsize(
+        args['source']) < transfer_cfg.multipart_threshold
+
     with subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
-        bufsize=1,
+        bufsize=65536,
         env=env
     ) as process:
-        stdout_thread = threading.Thread(
-            target=stream_output,
-            args=(
-                process.stdout,
-                False
-            )
-        )
-        stdout_thread.start()
         stderr_thread = threading.Thread(
             target=stream_output,
             args=(
@@ -324,25 +495,47 @@ def main() -> None:
             )
         )
         stderr_thread.start()
-        process.wait()
-        stdout_thread.join()
+
+        if small_source:
+            # Wait for a clean sops exit before shipping, and send a
+            # Content-MD5 so S3 verifies the body on arrival.
+            body = process.stdout.read()
+            bytes_uploaded = len(body)
+            if process.wait() == 0:
+                s3_client.put_object(
+                    Bucket=args.get('s3_bucket'),
+                    Key=args.get('target'),
+                    Body=body,
+                    ContentMD5=base64.b64encode(
+                        hashlib.md5(body).digest()
+                    ).decode()
+                )
+        else:
+            reader = CountingReader(process.stdout)
+            s3_client.upload_fileobj(
+                reader,
+                args.get('s3_bucket'),
+                args.get('target'),
+                Config=transfer_cfg
+            )
+            bytes_uploaded = reader.bytes_read
+            process.wait()
+
         stderr_thread.join()
         if process.returncode > 0:
             exit(1)
 
-    logger.trace('Creating S3 client')
-    s3_client = boto3.client("s3", region_name=region)
-
-    logger.trace(f'Written file {args.get("destination")}')
-
-    s3_client.upload_file(
-        args.get('destination'),
-        args.get('s3_bucket'),
-        args.get('target')
-    )
-
-    logger.info(
-        f'Uploaded file {args.get("target")} to {args.get("s3_bucket")}')
+    if args.get('log_json'):
+        logger.info({
+            'source': args.get('source'),
+            'target': args.get('target'),
+            's3_bucket': args.get('s3_bucket'),
+            'bytes_uploaded': bytes_uploaded,
+            'duration_ms': round((time.monotonic() - started) * 1000),
+        })
+    else:
+        logger.info(
+            'Uploaded file %s to %s', args.get('target'), args.get('s3_bucket'))
 
 
 if __name__ == "__main__":